@@ -1,10 +1,14 @@
 """A sphinx extension for peeking at internal references."""
 from __future__ import annotations
 
+from collections import ChainMap
+import contextlib
 from dataclasses import dataclass, field, fields
 import json
 from pathlib import Path
-from typing import Any, ClassVar, TypedDict
+import re
+import time
+from typing import Any, AsyncGenerator, Callable, ClassVar, MutableMapping, TypedDict, cast
 
 from docutils import nodes
 from docutils.parsers.rst import directives
@@ -13,10 +17,24 @@ import jinja2
 from jinja2 import meta
 from sphinx.application import Sphinx
 from sphinx.config import Config
+from sphinx.environment import BuildEnvironment
 from sphinx.util import logging
 from sphinx.util.docutils import SphinxDirective
+from sphinx.util.matching import patmatch
 
+from ._async import map_concurrent, run_async
 from ._private import _JinjaConfigDirective, _JinjaExample
+from ._providers import get_provided_contexts, outdated_provider_docs, run_context_providers
+from ._shared import get_shared_contexts, share_contexts
+from ._usage import (
+    merge_usage,
+    purge_usage,
+    record_context,
+    record_usage,
+    start_read_timer,
+    stop_read_timer,
+    write_usage,
+)
 
 __version__ = "0.0.1"
 
@@ -28,6 +46,15 @@ def setup(app: Sphinx) -> dict[str, Any]:
 
     Jinja2Config.to_config(app)
     app.add_directive("jinja", JinjaDirective)
+    app.connect("builder-inited", run_context_providers)
+    app.connect("builder-inited", share_contexts)
+    app.connect("source-read", start_read_timer)
+    app.connect("source-read", render_source)
+    app.connect("doctree-read", stop_read_timer)
+    app.connect("env-purge-doc", purge_usage)
+    app.connect("env-merge-info", merge_usage)
+    app.connect("env-get-outdated", outdated_provider_docs)
+    app.connect("build-finished", write_usage)
     # private directives to document the jinja2 extension
     app.add_directive("jinja2-config", _JinjaConfigDirective)
     app.add_directive("jinja2-example", _JinjaExample)
@@ -61,6 +88,48 @@ class Jinja2Config:
             "doc": "A mapping of test names to test functions (see `<https://jinja.palletsprojects.com/en/3.1.x/api/#writing-tests>`__)"
         },
     )
+    context_providers: dict[str, Any] = field(
+        default_factory=dict,
+        metadata={
+            "doc": "A mapping of context names to callables (or coroutine functions), "
+            "returning context variables, which are run concurrently at the start of the build. "
+            "A value may also be a ``(callable, timeout)`` tuple",
+            # callables cannot be cached by sphinx, so would always trigger a full rebuild,
+            # instead documents are re-read when the hash of a provided context changes
+            "rebuild": "",
+        },
+    )
+    provider_timeout: float | None = field(
+        default=60.0,
+        metadata={
+            "doc": "Default timeout in seconds for each context provider (``None`` to disable)"
+        },
+    )
+    render_sources: dict[str, str | None] = field(
+        default_factory=dict,
+        metadata={
+            "doc": "A mapping of docname glob patterns to a context name (or ``None``), "
+            "for documents to render as templates before they are parsed"
+        },
+    )
+    shared_contexts: list[str] = field(
+        default_factory=list,
+        metadata={
+            "doc": "Names of (large) contexts from ``jinja2_context_providers``, to serialize once "
+            "to a memory-mapped file in the build directory, which is read lazily by parallel workers"
+        },
+    )
+    globals: dict[str, Any] = field(
+        default_factory=dict,
+        metadata={"doc": "A mapping of global names to values (such as functions)"},
+    )
+    async_render: bool = field(
+        default=False,
+        metadata={
+            "doc": "Render templates asynchronously, "
+            "allowing for coroutine filters and globals, and the ``map_concurrent`` filter"
+        },
+    )
     debug: bool = field(default=False, metadata={"doc": "Output the rendered template"})
 
     @classmethod
@@ -75,7 +144,11 @@ class Jinja2Config:
     def to_config(cls, app: Sphinx) -> None:
         """Add configuration values."""
         for _field in fields(cls):
-            app.add_config_value(f"jinja2_{_field.name}", getattr(cls(), _field.name), "env")
+            app.add_config_value(
+                f"jinja2_{_field.name}",
+                getattr(cls(), _field.name),
+                _field.metadata.get("rebuild", "env"),
+            )
 
 
 class JinjaOptions(TypedDict, total=False):
@@ -110,18 +183,9 @@ class JinjaDirective(SphinxDirective):
 
         # create the context
         # precedence level: default < global < directive
-        ctx = {"env": self.env}
-        if self.arguments:
-            name = self.arguments[0]
-            if name not in conf.contexts:
-                _warn(f"Context {self.arguments[0]!r} not found in jinja2_contexts")
-                return []
-            if not isinstance(conf.contexts[name], dict):
-                _warn(
-                    f"Expected context {name!r} to be a dict, got {type(conf.contexts[name]).__name__}"
-                )
-                return []
-            ctx.update(conf.contexts[name])
+        ctx = create_context(self.env, conf, self.arguments[0] if self.arguments else None, _warn)
+        if ctx is None:
+            return []
         if "ctx" in self.options:
             try:
                 ctx_option = json.loads(self.options["ctx"])
@@ -134,31 +198,17 @@ class JinjaDirective(SphinxDirective):
             ctx.update(ctx_option)
 
         # create the jinja environment
-        template_base = Path(str(self.env.app.srcdir))
-        env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(template_base),
-            undefined=jinja2.StrictUndefined,
-            **conf.env_kwargs,
-        )
-
-        # add the filters and tests
-        try:
-            env.filters.update(conf.filters)
-        except Exception as exc:
-            _warn(f"Error adding filters: {exc.__class__.__name__}: {exc}")
-            return []
-        try:
-            env.tests.update(conf.tests)
-        except Exception as exc:
-            _warn(f"Error adding tests: {exc.__class__.__name__}: {exc}")
+        env = create_environment(self.env, conf, _warn)
+        if env is None:
             return []
 
         # get the jinja template, from file or content
         source, line = self.get_source_info()
+        templates: set[str] = set()
         if template_filename := self.options.get("file"):
             if self.content:
                 _warn("Both file and content specified, ignoring content")
-            _, source = self.env.relfn2path(template_filename)
+            relpath, source = self.env.relfn2path(template_filename)
             line = 1
             try:
                 with open(source, encoding="utf8") as f:
@@ -167,25 +217,21 @@ class JinjaDirective(SphinxDirective):
                 _warn(f"Error reading template file {source}: {exc}")
                 return []
             self.env.note_dependency(source)
+            templates.add(relpath)
         else:
             content = "\n".join(self.content)
 
         # note all dependent templates
-        ast = env.parse(content)
-        for template in meta.find_referenced_templates(ast):
-            if template is None:
-                continue
-            template_path = template_base / template
-            if template_path.is_file():
-                self.env.note_dependency(str(template_path))
+        templates |= note_template_dependencies(self.env, env, content)
 
         # render the template, with the context
-        tpl = env.from_string(content)
+        start = time.perf_counter()
         try:
-            new_content = tpl.render(**ctx)
+            new_content = render_template(env.from_string(content), ctx)
         except Exception as exc:
             _warn(f"Error rendering jinja template: {exc.__class__.__name__}: {exc}")
             return []
+        record_usage(self.env, templates, time.perf_counter() - start)
 
         # insert the new content into the source stream
         # setting the source and line number
@@ -201,3 +247,187 @@ class JinjaDirective(SphinxDirective):
             return [rendered]
 
         return []
+
+
+def create_context(
+    env: BuildEnvironment, conf: Jinja2Config, name: str | None, warn: Callable[[str], None]
+) -> ChainMap[str, Any] | None:
+    """Create the template context, from the default and (optional) named global context.
+
+    Further variables can be added with ``update``, which take precedence over these.
+    Returns None (after warning) if the named context is missing or invalid.
+    """
+    ctx: ChainMap[str, Any] = ChainMap({}, {"env": env})
+    if name is not None:
+        record_context(env, name)
+        shared = get_shared_contexts(env.app)
+        if shared is not None and name in shared:
+            # use a lazy view, rather than copying the context,
+            # this is never written to, since updates only go to the first map
+            ctx.maps.insert(1, cast("MutableMapping[str, Any]", shared.view(name)))
+            return ctx
+        contexts = {**conf.contexts, **get_provided_contexts(env.app)}
+        if name not in contexts:
+            if name in conf.context_providers:
+                # the provider will have failed, and been reported at the start of the build
+                warn(f"Context {name!r} not found in jinja2_context_providers")
+            else:
+                warn(f"Context {name!r} not found in jinja2_contexts")
+            return None
+        if not isinstance(contexts[name], dict):
+            warn(f"Expected context {name!r} to be a dict, got {type(contexts[name]).__name__}")
+            return None
+        ctx.maps.insert(1, contexts[name])
+    return ctx
+
+
+def render_template(template: jinja2.Template, ctx: ChainMap[str, Any]) -> str:
+    """Render a template, without first copying the context into a new dict."""
+    # note, globals must be added explicitly to a shared context,
+    # and jinja only requires a mapping (not a dict) for the variables
+    variables = ChainMap(*ctx.maps, template.globals)
+    context = template.new_context(variables, shared=True)  # type: ignore[arg-type]
+    concat = template.environment.concat
+    if template.environment.is_async:
+
+        async def _render() -> str:
+            # in async mode, the render function is an async generator
+            agen = cast("AsyncGenerator[str, None]", template.root_render_func(context))
+            try:
+                return concat([n async for n in agen])
+            finally:
+                await agen.aclose()
+
+        return run_async(_render())
+    return concat(template.root_render_func(context))
+
+
+def create_environment(
+    env: BuildEnvironment, conf: Jinja2Config, warn: Callable[[str], None]
+) -> jinja2.Environment | None:
+    """Create the jinja environment, with the configured filters, tests and globals.
+
+    Returns None (after warning) if the filters, tests or globals cannot be added.
+    """
+    env_kwargs = dict(conf.env_kwargs)
+    if conf.async_render:
+        env_kwargs["enable_async"] = True
+    jinja_env = jinja2.Environment(
+        loader=jinja2.FileSystemLoader(Path(str(env.app.srcdir))),
+        undefined=jinja2.StrictUndefined,
+        **env_kwargs,
+    )
+    if jinja_env.is_async:
+        jinja_env.filters["map_concurrent"] = map_concurrent
+    try:
+        jinja_env.filters.update(conf.filters)
+    except Exception as exc:
+        warn(f"Error adding filters: {exc.__class__.__name__}: {exc}")
+        return None
+    try:
+        jinja_env.tests.update(conf.tests)
+    except Exception as exc:
+        warn(f"Error adding tests: {exc.__class__.__name__}: {exc}")
+        return None
+    try:
+        jinja_env.globals.update(conf.globals)
+    except Exception as exc:
+        warn(f"Error adding globals: {exc.__class__.__name__}: {exc}")
+        return None
+    return jinja_env
+
+
+def note_template_dependencies(
+    env: BuildEnvironment, jinja_env: jinja2.Environment, content: str
+) -> set[str]:
+    """Note all templates referenced by the content, including transitively,
+    as dependencies of the current document.
+
+    :returns: the referenced template names
+    """
+    template_base = Path(str(env.app.srcdir))
+    found: set[str] = set()
+    asts = [jinja_env.parse(content)]
+    while asts:
+        for template in meta.find_referenced_templates(asts.pop()):
+            if template is None or template in found:
+                continue
+            template_path = template_base / template
+            if not template_path.is_file():
+                continue
+            found.add(template)
+            env.note_dependency(str(template_path))
+            # errors will be reported on rendering
+            with contextlib.suppress(OSError, jinja2.TemplateSyntaxError):
+                asts.append(jinja_env.parse(template_path.read_text(encoding="utf8")))
+    return found
+
+
+_DOCINFO_BLOCK = re.compile(
+    r"\A(?:[ \t]*\n)*"  # leading blank lines
+    r"((?::[^:\n]+:[^\n]*(?:\n|\Z)"  # a field
+    r"(?:[ \t]+\S[^\n]*(?:\n|\Z))*)+)"  # and its indented continuation lines
+)
+"""The field list at the top of a document (which docutils converts to file-wide metadata)."""
+_RENDER_SOURCE_FIELD = re.compile(r"^:jinja2-render:[ \t]*(\S*)[ \t]*$", re.MULTILINE)
+
+
+def _render_source_field(content: str) -> re.Match[str] | None:
+    """Find the ``:jinja2-render:`` field, in the field list at the top of a document."""
+    if (docinfo := _DOCINFO_BLOCK.match(content)) is None:
+        return None
+    return _RENDER_SOURCE_FIELD.search(docinfo.group(1))
+
+
+def render_source(app: Sphinx, docname: str, source: list[str]) -> None:
+    """Render a whole document as a jinja template, before it is parsed.
+
+    Documents are selected by ``jinja2_render_sources`` glob patterns,
+    or by a ``:jinja2-render:`` file-wide metadata field.
+    """
+    conf = Jinja2Config.from_config(app.config)
+    content = source[0]
+
+    # fast path: skip documents that contain no jinja delimiters
+    delimiters = [
+        conf.env_kwargs.get("variable_start_string", "{{"),
+        conf.env_kwargs.get("block_start_string", "{%"),
+        conf.env_kwargs.get("comment_start_string", "{#"),
+    ]
+    # line comments may follow other content, but line statements must start a line
+    if line_comment_prefix := conf.env_kwargs.get("line_comment_prefix"):
+        delimiters.append(line_comment_prefix)
+    line_statement_prefix = conf.env_kwargs.get("line_statement_prefix")
+    if not any(delimiter in content for delimiter in delimiters) and not (
+        line_statement_prefix
+        and re.search(rf"^[ \t]*{re.escape(line_statement_prefix)}", content, re.MULTILINE)
+    ):
+        return
+
+    # select the document, and its context name
+    ctx_name: str | None
+    if (match := _render_source_field(content)) is not None:
+        ctx_name = match.group(1) or None
+    else:
+        pattern = next((p for p in conf.render_sources if patmatch(docname, p)), None)
+        if pattern is None:
+            return
+        ctx_name = conf.render_sources[pattern]
+
+    def _warn(msg: str) -> None:
+        LOGGER.warning(msg + " [jinja2]", location=docname, type="jinja2")
+
+    ctx = create_context(app.env, conf, ctx_name, _warn)
+    if ctx is None:
+        return
+    env = create_environment(app.env, conf, _warn)
+    if env is None:
+        return
+    start = time.perf_counter()
+    try:
+        templates = note_template_dependencies(app.env, env, content)
+        source[0] = render_template(env.from_string(content), ctx)
+    except Exception as exc:
+        _warn(f"Error rendering jinja template: {exc.__class__.__name__}: {exc}")
+        return
+    record_usage(app.env, templates, time.perf_counter() - start)
@@ -0,0 +1,71 @@
+"""Support for rendering templates asynchronously."""
+from __future__ import annotations
+
+import asyncio
+import functools
+import inspect
+import os
+from typing import Any, Coroutine, TypeVar
+
+import jinja2
+
+try:
+    from jinja2 import pass_context
+except ImportError:  # jinja2 < 3.0
+    from jinja2 import contextfilter as pass_context  # type: ignore[attr-defined,no-redef]
+
+T = TypeVar("T")
+
+_LOOP: tuple[int, asyncio.AbstractEventLoop] | None = None
+
+
+def run_async(coro: Coroutine[Any, Any, T]) -> T:
+    """Run a coroutine to completion, on an event loop for the current process.
+
+    The loop is re-created after a fork, so that parallel workers do not share it.
+    """
+    global _LOOP
+    if _LOOP is None or _LOOP[0] != os.getpid() or _LOOP[1].is_closed():
+        _LOOP = (os.getpid(), asyncio.new_event_loop())
+    return _LOOP[1].run_until_complete(coro)
+
+
+@pass_context
+async def map_concurrent(
+    context: jinja2.runtime.Context, seq: Any, name: str, *args: Any, **kwargs: Any
+) -> list[Any]:
+    """Apply a filter to each item of a sequence concurrently, returning the results in order.
+
+    Coroutine filters are awaited together, and other filters are run in a thread pool.
+    """
+    environment = context.environment
+    if name not in environment.filters:
+        raise jinja2.TemplateRuntimeError(f"No filter named {name!r}")
+    loop = asyncio.get_running_loop()
+
+    async def _call(item: Any) -> Any:
+        call = functools.partial(environment.call_filter, name, item, args, kwargs, context=context)
+        if inspect.iscoroutinefunction(environment.filters[name]):
+            result = call()
+        else:
+            result = await loop.run_in_executor(None, call)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
+
+    tasks = [asyncio.ensure_future(_call(item)) async for item in _aiter(seq)]
+    try:
+        return list(await asyncio.gather(*tasks))
+    finally:
+        # do not leave running tasks, if any of them failed
+        for task in tasks:
+            task.cancel()
+
+
+async def _aiter(seq: Any) -> Any:
+    if hasattr(seq, "__aiter__"):
+        async for item in seq:
+            yield item
+    else:
+        for item in seq:
+            yield item
@@ -0,0 +1,181 @@
+"""Concurrent prefetching of context providers, at the start of the build."""
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from typing import Any, Callable
+
+from sphinx.application import Sphinx
+from sphinx.environment import BuildEnvironment
+from sphinx.util import logging
+
+from ._usage import get_usage
+
+LOGGER = logging.getLogger(__name__)
+
+PROVIDED_CONTEXTS_ATTR = "_jinja2_provided_contexts"
+"""The attribute of the Sphinx application, on which provided contexts are stored."""
+
+PROVIDER_HASHES_ATTR = "jinja2_provider_hashes"
+"""The attribute of the Sphinx application (for the current build)
+and build environment (for the previous build), on which hashes of provided contexts are stored.
+"""
+
+
+def get_provided_contexts(app: Sphinx) -> dict[str, Any]:
+    """Get the contexts that were computed by the context providers."""
+    return getattr(app, PROVIDED_CONTEXTS_ATTR, {})
+
+
+def run_context_providers(app: Sphinx) -> None:
+    """Run all ``jinja2_context_providers`` concurrently, and store their results on the app.
+
+    Coroutine functions are awaited directly on an event loop,
+    and blocking callables are run in daemon threads,
+    so that a timed out provider does not block the build from finishing.
+    """
+    from . import Jinja2Config
+
+    conf = Jinja2Config.from_config(app.config)
+    providers: dict[str, tuple[Callable[[], Any], float | None]] = {}
+    for name, value in conf.context_providers.items():
+        func, timeout = value if isinstance(value, tuple) else (value, conf.provider_timeout)
+        if not callable(func):
+            _warn(f"Context provider {name!r} is not callable")
+            continue
+        if name in conf.contexts:
+            _warn(f"Context provider {name!r} shadows a jinja2_contexts entry, ignoring provider")
+            continue
+        providers[name] = (func, timeout)
+
+    results: dict[str, Any] = {}
+    hashes: dict[str, str] = {}
+    setattr(app, PROVIDED_CONTEXTS_ATTR, results)
+    setattr(app, PROVIDER_HASHES_ATTR, hashes)
+    if not providers:
+        return
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        _warn("Cannot run context providers, since an event loop is already running")
+        return
+
+    start = time.perf_counter()
+    outcomes = asyncio.run(_run_all(providers))
+
+    for name, (outcome, duration) in outcomes.items():
+        if isinstance(outcome, BaseException):
+            if isinstance(outcome, asyncio.TimeoutError):
+                msg = f"timed out after {providers[name][1]}s"
+            else:
+                msg = f"{outcome.__class__.__name__}: {outcome}"
+            _warn(f"Error running context provider {name!r}: {msg}")
+            continue
+        results[name] = outcome
+        hashes[name] = _hash(name, outcome)
+        LOGGER.verbose(f"[jinja2] context provider {name!r} finished in {duration:.3f}s")
+
+    LOGGER.info(
+        f"[jinja2] ran {len(providers)} context provider(s) in {time.perf_counter() - start:.3f}s"
+    )
+
+
+def outdated_provider_docs(
+    app: Sphinx, env: BuildEnvironment, added: set[str], changed: set[str], removed: set[str]
+) -> list[str]:
+    """Mark documents as outdated, which use provided contexts that changed since the last build."""
+    new_hashes: dict[str, str] = getattr(app, PROVIDER_HASHES_ATTR, {})
+    old_hashes: dict[str, str] = getattr(env, PROVIDER_HASHES_ATTR, {})
+    setattr(env, PROVIDER_HASHES_ATTR, new_hashes)
+    names = {
+        name
+        for name in old_hashes.keys() | new_hashes.keys()
+        if old_hashes.get(name) != new_hashes.get(name)
+    }
+    if not names:
+        return []
+    return [
+        docname
+        for docname, usage in get_usage(env).items()
+        if docname not in removed and names.intersection(usage["contexts"])
+    ]
+
+
+def _hash(name: str, result: Any) -> str:
+    """Hash a provided context, to detect changes between builds.
+
+    The hash is of a canonical JSON form, since pickling is not stable across processes
+    (for example, the order of sets of strings depends on the per-process hash seed).
+    """
+    try:
+        data = json.dumps(result, sort_keys=True, default=_json_default).encode("utf8")
+    except (TypeError, ValueError) as exc:
+        LOGGER.verbose(
+            f"[jinja2] context provider {name!r} result cannot be hashed, "
+            f"so documents using it are re-read on every build: {exc}"
+        )
+        data = os.urandom(16)
+    return hashlib.sha256(data).hexdigest()
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=repr)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _warn(msg: str) -> None:
+    LOGGER.warning(msg + " [jinja2]", type="jinja2")
+
+
+def _run_in_thread(func: Callable[[], Any]) -> asyncio.Future[Any]:
+    """Run a blocking callable in a daemon thread, which is not joined at exit."""
+    loop = asyncio.get_running_loop()
+    future: asyncio.Future[Any] = loop.create_future()
+
+    def _set(setter: Callable[[Any], None], value: Any) -> None:
+        # the future will have been cancelled, if the provider timed out
+        if not future.done():
+            setter(value)
+
+    def _target() -> None:
+        try:
+            result = func()
+        except Exception as exc:
+            outcome: tuple[Callable[[Any], None], Any] = (future.set_exception, exc)
+        else:
+            outcome = (future.set_result, result)
+        # the event loop may have been closed, after the provider timed out
+        with contextlib.suppress(RuntimeError):
+            loop.call_soon_threadsafe(_set, *outcome)
+
+    threading.Thread(target=_target, name="jinja2-provider", daemon=True).start()
+    return future
+
+
+async def _run_all(
+    providers: dict[str, tuple[Callable[[], Any], float | None]],
+) -> dict[str, tuple[Any, float]]:
+    """Run all providers concurrently, returning a mapping of name -> (result/exception, time)."""
+
+    async def _run_one(func: Callable[[], Any], timeout: float | None) -> tuple[Any, float]:
+        start = time.perf_counter()
+        try:
+            awaitable = func() if inspect.iscoroutinefunction(func) else _run_in_thread(func)
+            result = await asyncio.wait_for(awaitable, timeout)
+        except Exception as exc:
+            result = exc
+        return result, time.perf_counter() - start
+
+    names = list(providers)
+    outcomes = await asyncio.gather(*(_run_one(*providers[name]) for name in names))
+    return dict(zip(names, outcomes))
@@ -0,0 +1,171 @@
+"""Sharing of large contexts across parallel read workers, via a memory-mapped file."""
+from __future__ import annotations
+
+import json
+import mmap
+import os
+from pathlib import Path
+import pickle
+import struct
+from typing import Any, Iterator, Mapping
+
+from sphinx.application import Sphinx
+from sphinx.util import logging
+
+from ._providers import get_provided_contexts
+
+LOGGER = logging.getLogger(__name__)
+
+SHARED_CONTEXTS_ATTR = "_jinja2_shared_contexts"
+"""The attribute of the Sphinx application, on which the shared contexts file is stored."""
+
+SHARED_CONTEXTS_FILENAME = "jinja2_contexts.mmap"
+
+_MAGIC = b"SJ2C"
+_HEADER = struct.Struct("<4sQ")
+
+
+class SharedContext(Mapping[str, Any]):
+    """A lazy, read-only view of a context in the shared file.
+
+    Values are only unpickled (from the memory-mapped buffer, without copying) when first accessed,
+    and are then cached for the lifetime of the view.
+    """
+
+    def __init__(self, buffer: mmap.mmap, index: dict[str, tuple[int, int]]) -> None:
+        self._buffer = buffer
+        self._index = index
+        self._cache: dict[str, Any] = {}
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._cache:
+            offset, length = self._index[key]
+            with memoryview(self._buffer) as view:
+                self._cache[key] = pickle.loads(view[offset : offset + length])
+        return self._cache[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._index)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+
+class SharedContexts:
+    """A read-only memory-mapped file of contexts."""
+
+    def __init__(self, path: Path) -> None:
+        with path.open("rb") as handle:
+            self._buffer = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_length = _HEADER.unpack_from(self._buffer)
+        if magic != _MAGIC:
+            raise ValueError(f"Not a shared contexts file: {path}")
+        start = _HEADER.size + index_length
+        index = json.loads(self._buffer[_HEADER.size : start])
+        self._index: dict[str, dict[str, tuple[int, int]]] = {
+            name: {key: (start + offset, length) for key, (offset, length) in keys.items()}
+            for name, keys in index.items()
+        }
+
+        self._views: dict[str, SharedContext] = {}
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._index
+
+    def view(self, name: str) -> SharedContext:
+        """Get the lazy view of a context.
+
+        A single view is kept per context (and so per process, for forked workers),
+        so that each value is unpickled at most once per process.
+        """
+        if name not in self._views:
+            self._views[name] = SharedContext(self._buffer, self._index[name])
+        return self._views[name]
+
+
+def write_shared_contexts(path: Path, contexts: dict[str, dict[str, Any]]) -> None:
+    """Write contexts to a file, with each top-level value pickled separately."""
+    index: dict[str, dict[str, tuple[int, int]]] = {}
+    blobs: list[bytes] = []
+    offset = 0
+    for name, context in contexts.items():
+        index[name] = {}
+        for key, value in context.items():
+            blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+            index[name][key] = (offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+    # offsets are relative to the start of the data, after the index
+    index_bytes = json.dumps(index).encode("utf8")
+
+    temp_path = path.with_suffix(".tmp")
+    with temp_path.open("wb") as handle:
+        handle.write(_HEADER.pack(_MAGIC, len(index_bytes)))
+        handle.write(index_bytes)
+        for blob in blobs:
+            handle.write(blob)
+    os.replace(temp_path, path)
+
+
+def get_shared_contexts(app: Sphinx) -> SharedContexts | None:
+    """Get the shared contexts file, if one was written for this build."""
+    return getattr(app, SHARED_CONTEXTS_ATTR, None)
+
+
+def share_contexts(app: Sphinx) -> None:
+    """Serialize ``jinja2_shared_contexts`` to a memory-mapped file in the build directory.
+
+    This is run in the main process, before any parallel read workers are forked,
+    so that they all inherit the same read-only mapping.
+    Only contexts from ``jinja2_context_providers`` can be shared,
+    since those in ``jinja2_contexts`` are part of the Sphinx configuration,
+    which is held by every worker and pickled with the environment.
+    The shared contexts are then released from memory.
+    """
+    from . import Jinja2Config
+
+    conf = Jinja2Config.from_config(app.config)
+    setattr(app, SHARED_CONTEXTS_ATTR, None)
+    if not conf.shared_contexts:
+        return
+
+    provided = get_provided_contexts(app)
+    contexts: dict[str, dict[str, Any]] = {}
+    for name in conf.shared_contexts:
+        if name in conf.contexts:
+            _warn(
+                f"Shared context {name!r} is in jinja2_contexts, "
+                "only jinja2_context_providers contexts can be shared"
+            )
+            continue
+        if name not in provided:
+            _warn(f"Shared context {name!r} not found in jinja2_context_providers")
+            continue
+        context = provided[name]
+        if not isinstance(context, dict):
+            # this is left to be reported by the directive
+            continue
+        if not all(isinstance(key, str) for key in context):
+            _warn(f"Shared context {name!r} has non-string keys, not sharing")
+            continue
+        contexts[name] = context
+
+    path = Path(str(app.doctreedir)) / SHARED_CONTEXTS_FILENAME
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        write_shared_contexts(path, contexts)
+    except Exception as exc:
+        _warn(f"Error writing shared contexts: {exc.__class__.__name__}: {exc}")
+        return
+    setattr(app, SHARED_CONTEXTS_ATTR, SharedContexts(path))
+    for name in contexts:
+        del provided[name]
+
+    LOGGER.verbose(f"[jinja2] wrote {len(contexts)} shared context(s) to {path}")
+
+
+def _warn(msg: str) -> None:
+    LOGGER.warning(msg + " [jinja2]", type="jinja2")
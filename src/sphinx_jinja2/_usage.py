@@ -0,0 +1,112 @@
+"""An index of which documents use which templates and contexts, and how long they took."""
+from __future__ import annotations
+
+import json
+from pathlib import Path
+import time
+from typing import Any, TypedDict
+
+from docutils import nodes
+from sphinx.application import Sphinx
+from sphinx.environment import BuildEnvironment
+from sphinx.util import logging
+
+LOGGER = logging.getLogger(__name__)
+
+USAGE_ENV_ATTR = "jinja2_usage"
+"""The attribute of the build environment, on which the usage index is stored."""
+
+USAGE_FILENAME = "jinja2_usage.json"
+
+_READ_START_KEY = "jinja2_read_start"
+
+
+class DocUsage(TypedDict):
+    """The jinja usage of a single document."""
+
+    templates: list[str]
+    """Template paths (relative to the source directory), including transitive references"""
+    contexts: list[str]
+    """Named contexts"""
+    render_time: float
+    """Total time in seconds spent rendering templates"""
+    read_time: float
+    """Time in seconds taken to read the document (recorded for all documents)"""
+
+
+def get_usage(env: BuildEnvironment) -> dict[str, DocUsage]:
+    """Get the usage index, from the build environment."""
+    if not hasattr(env, USAGE_ENV_ATTR):
+        setattr(env, USAGE_ENV_ATTR, {})
+    return getattr(env, USAGE_ENV_ATTR)  # type: ignore[no-any-return]
+
+
+def _doc_usage(env: BuildEnvironment) -> DocUsage:
+    return get_usage(env).setdefault(
+        env.docname, {"templates": [], "contexts": [], "render_time": 0.0, "read_time": 0.0}
+    )
+
+
+def record_context(env: BuildEnvironment, context: str) -> None:
+    """Record a named context being requested by the current document.
+
+    This is recorded even if the context is missing or invalid,
+    so that the document is re-read if it is later provided.
+    """
+    usage = _doc_usage(env)
+    if context not in usage["contexts"]:
+        usage["contexts"].append(context)
+
+
+def record_usage(env: BuildEnvironment, templates: set[str], render_time: float) -> None:
+    """Record a template rendering for the current document."""
+    usage = _doc_usage(env)
+    usage["templates"] = sorted(set(usage["templates"]) | templates)
+    usage["render_time"] += render_time
+
+
+def start_read_timer(app: Sphinx, docname: str, source: list[str]) -> None:
+    """Record the start of reading a document."""
+    app.env.temp_data[_READ_START_KEY] = time.perf_counter()
+
+
+def stop_read_timer(app: Sphinx, doctree: nodes.document) -> None:
+    """Record the time taken to read a document.
+
+    This is recorded for all documents, to estimate the cost of a full rebuild.
+    """
+    start = app.env.temp_data.get(_READ_START_KEY)
+    if start is not None:
+        _doc_usage(app.env)["read_time"] = time.perf_counter() - start
+
+
+def purge_usage(app: Sphinx, env: BuildEnvironment, docname: str) -> None:
+    """Remove a document from the usage index."""
+    get_usage(env).pop(docname, None)
+
+
+def merge_usage(
+    app: Sphinx, env: BuildEnvironment, docnames: set[str], other: BuildEnvironment
+) -> None:
+    """Merge the usage index from a parallel read worker."""
+    other_usage = get_usage(other)
+    usage = get_usage(env)
+    for docname in docnames:
+        if docname in other_usage:
+            usage[docname] = other_usage[docname]
+
+
+def write_usage(app: Sphinx, exception: Exception | None) -> None:
+    """Write the usage index as JSON to the build directory."""
+    if exception is not None:
+        return
+    path = Path(str(app.doctreedir)) / USAGE_FILENAME
+    data: dict[str, Any] = {
+        "srcdir": str(app.srcdir),
+        # changing these config values triggers a full rebuild
+        "config_contexts": sorted(app.config.jinja2_contexts),
+        "documents": dict(sorted(get_usage(app.env).items())),
+    }
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2), encoding="utf8")
+    LOGGER.verbose(f"[jinja2] wrote usage index to {path}")
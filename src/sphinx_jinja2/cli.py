@@ -0,0 +1,101 @@
+"""Command-line interface, to query the template/context usage index written by a build."""
+from __future__ import annotations
+
+import argparse
+import json
+from pathlib import Path
+import sys
+from typing import Any, Sequence
+
+DEFAULT_TEMPLATE_PATTERNS = ("*.jinja", "*.jinja2", "*.j2")
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    """Run the command-line interface."""
+    parser = argparse.ArgumentParser(
+        prog="sphinx-jinja2",
+        description="Query the jinja2_usage.json index, written to the doctrees build directory.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    impact = subparsers.add_parser(
+        "impact", help="List the documents that are re-read if templates or contexts change"
+    )
+    impact.add_argument("index", type=Path, help="Path to jinja2_usage.json")
+    impact.add_argument("names", nargs="+", help="Template paths or context names")
+
+    unused = subparsers.add_parser("unused", help="List templates that are never used")
+    unused.add_argument("index", type=Path, help="Path to jinja2_usage.json")
+    unused.add_argument(
+        "-p",
+        "--pattern",
+        action="append",
+        dest="patterns",
+        help="Glob pattern for template files, in the source directory "
+        f"(default: {', '.join(DEFAULT_TEMPLATE_PATTERNS)})",
+    )
+
+    args = parser.parse_args(argv)
+    try:
+        data = json.loads(args.index.read_text(encoding="utf8"))
+    except (OSError, ValueError) as exc:
+        print(f"Error reading usage index {args.index}: {exc}", file=sys.stderr)
+        return 1
+
+    if args.command == "impact":
+        return _impact(data, args.names)
+    return _unused(data, args.patterns or DEFAULT_TEMPLATE_PATTERNS)
+
+
+def _impact(data: dict[str, Any], names: list[str]) -> int:
+    srcdir = Path(data["srcdir"])
+    targets = {_template_name(name, srcdir) for name in names}
+    if config_names := sorted(targets.intersection(data["config_contexts"])):
+        # jinja2_contexts is a config value, so any change to it re-reads every document
+        for name in config_names:
+            print(f"{name!r} is in jinja2_contexts, so changing it re-reads all documents")
+        affected = data["documents"]
+    else:
+        affected = {
+            docname: usage
+            for docname, usage in data["documents"].items()
+            if targets & (set(usage["templates"]) | set(usage["contexts"]))
+        }
+        for docname, usage in affected.items():
+            print(f"{docname} ({_read_time(usage):.3f}s)")
+    total = sum(_read_time(usage) for usage in affected.values())
+    print(f"{len(affected)} document(s) affected, estimated re-read time {total:.3f}s")
+    return 0
+
+
+def _unused(data: dict[str, Any], patterns: Sequence[str]) -> int:
+    srcdir = Path(data["srcdir"])
+    used = {template for usage in data["documents"].values() for template in usage["templates"]}
+    candidates = {
+        path.relative_to(srcdir).as_posix()
+        for pattern in patterns
+        for path in srcdir.rglob(pattern)
+        if path.is_file()
+    }
+    for template in sorted(candidates - used):
+        print(template)
+    return 0
+
+
+def _template_name(name: str, srcdir: Path) -> str:
+    """Convert an existing file path to a template name, relative to the source directory."""
+    path = Path(name).resolve()
+    if path.is_file():
+        try:
+            return path.relative_to(srcdir.resolve()).as_posix()
+        except ValueError:
+            pass
+    return name
+
+
+def _read_time(usage: dict[str, Any]) -> float:
+    return usage["read_time"] or usage["render_time"]  # type: ignore[no-any-return]
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import json
 from pathlib import Path
 import pickle
 import shutil
 import subprocess
 from textwrap import dedent
+import time
 
 from docutils import nodes
 
@@ -34,7 +36,7 @@ class BuildResult:
         return doc
 
 
-def run_sphinxbuild(path: Path, clear_build: bool = True) -> BuildResult:
+def run_sphinxbuild(path: Path, clear_build: bool = True, jobs: int | None = None) -> BuildResult:
     build_path = path / "_build"
     if clear_build and build_path.is_dir():
         shutil.rmtree("_build")
@@ -48,7 +50,8 @@ def run_sphinxbuild(path: Path, clear_build: bool = True) -> BuildResult:
     with stdout_file.open("w") as sphinx_stdout, stderr_file.open("w") as sphinx_stderr:
         try:
             subprocess.check_call(
-                ["python", "-m", "sphinx", "-M", "html", str(path), str(build_path), "-T"],
+                ["python", "-m", "sphinx", "-M", "html", str(path), str(build_path), "-T"]
+                + (["-j", str(jobs)] if jobs else []),
                 stdout=sphinx_stdout,
                 stderr=sphinx_stderr,
             )
@@ -414,3 +417,524 @@ def test_template_inheritance(tmp_path: Path, snapshot_doctree):
     result = run_sphinxbuild(tmp_path, clear_build=False)
     assert not result.stderr
     assert result.doctree() == snapshot_doctree
+
+
+def test_context_providers(tmp_path: Path):
+    """Test that sync and async context providers are run, and their results used."""
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + dedent(
+            """\
+        import asyncio
+        import time
+
+        def sync_provider():
+            return {"a": "foo"}
+
+        async def async_provider():
+            await asyncio.sleep(0.01)
+            return {"b": "bar"}
+
+        def slow_provider():
+            time.sleep(2)
+            return {}
+
+        def bad_provider():
+            return 123
+
+        jinja2_context_providers = {
+            "sync": sync_provider,
+            "async": async_provider,
+            "slow": (slow_provider, 0.1),
+            "bad": bad_provider,
+        }
+        """
+        )
+    )
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. jinja:: sync
+
+            {{ a }}
+
+        .. jinja:: async
+
+            {{ b }}
+
+        .. jinja:: slow
+
+            slow
+
+        .. jinja:: bad
+
+            bad
+        """
+        )
+    )
+    result = run_sphinxbuild(tmp_path)
+    assert "Error running context provider 'slow': timed out after 0.1s" in result.stderr
+    assert (
+        "index.rst:11: WARNING: Context 'slow' not found in jinja2_context_providers"
+        in result.stderr
+    )
+    assert "index.rst:15: WARNING: Expected context 'bad' to be a dict, got int" in result.stderr
+    assert "ran 4 context provider(s)" in result.stdout
+    text = result.doctree().astext()
+    assert "foo" in text
+    assert "bar" in text
+
+
+def test_context_provider_timeout(tmp_path: Path):
+    """Test that a hung blocking provider does not delay the end of the build."""
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + dedent(
+            """\
+        import time
+
+        def hung():
+            time.sleep(30)
+
+        jinja2_context_providers = {"hung": (hung, 0.1)}
+        """
+        )
+    )
+    (tmp_path / "index.rst").write_text("Test\n====\n")
+    start = time.perf_counter()
+    result = run_sphinxbuild(tmp_path)
+    assert time.perf_counter() - start < 20
+    assert "Error running context provider 'hung': timed out after 0.1s" in result.stderr
+
+
+def test_context_provider_changes(tmp_path: Path):
+    """Test that documents are re-read when a provided context changes."""
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + dedent(
+            """\
+        from pathlib import Path
+
+        def provider():
+            return {"value": (Path(__file__).parent / "value.txt").read_text()}
+
+        jinja2_context_providers = {"ctx": provider}
+        """
+        )
+    )
+    (tmp_path / "value.txt").write_text("one")
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. toctree::
+
+            other
+
+        .. jinja:: ctx
+
+            value={{ value }}
+        """
+        )
+    )
+    (tmp_path / "other.rst").write_text("Other\n=====\n")
+    result = run_sphinxbuild(tmp_path)
+    assert "value=one" in result.doctree().astext()
+    result = run_sphinxbuild(tmp_path, clear_build=False)
+    assert "0 changed" in result.stdout
+    (tmp_path / "value.txt").write_text("two")
+    result = run_sphinxbuild(tmp_path, clear_build=False)
+    assert "1 changed" in result.stdout
+    assert "value=two" in result.doctree().astext()
+
+
+def test_context_provider_set_unchanged(tmp_path: Path):
+    """Test that documents are not re-read when a provided context containing a set is unchanged,
+    since the iteration order of sets of strings varies between processes.
+    """
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + dedent(
+            """\
+        def provider():
+            return {"tags": {"alpha", "beta", "gamma", "delta"}}
+
+        jinja2_context_providers = {"ctx": provider}
+        """
+        )
+    )
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. jinja:: ctx
+
+            {{ tags|sort|join(",") }}
+        """
+        )
+    )
+    result = run_sphinxbuild(tmp_path)
+    assert "alpha,beta,delta,gamma" in result.doctree().astext()
+    for _ in range(3):
+        result = run_sphinxbuild(tmp_path, clear_build=False)
+        assert "0 changed" in result.stdout
+
+
+def test_render_sources(tmp_path: Path):
+    """Test that whole documents are rendered, when selected by glob or metadata field."""
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + "\njinja2_contexts = {'ctx1': {'a': 'foo'}}"
+        + "\njinja2_render_sources = {'glob/*': 'ctx1'}"
+    )
+    (tmp_path / "base.jinja").write_text("{{ a }}")
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. toctree::
+
+            glob/other
+            field
+            notop
+            plain
+        """
+        )
+    )
+    (tmp_path / "glob").mkdir()
+    (tmp_path / "glob" / "other.rst").write_text(
+        dedent(
+            """\
+        Glob
+        ====
+        {% include "base.jinja" %} {{ env.config.version }}
+        """
+        )
+    )
+    (tmp_path / "field.rst").write_text(
+        dedent(
+            """\
+        :jinja2-render: ctx1
+
+        Field
+        =====
+        {{ a }}
+        """
+        )
+    )
+    (tmp_path / "notop.rst").write_text(
+        dedent(
+            """\
+        Not top
+        =======
+
+        :jinja2-render: ctx1
+
+        {{ a }}
+        """
+        )
+    )
+    (tmp_path / "plain.rst").write_text(
+        dedent(
+            """\
+        Plain
+        =====
+        {{ a }}
+        """
+        )
+    )
+    result = run_sphinxbuild(tmp_path)
+    assert not result.stderr
+    assert "foo 2.0" in result.doctree("glob/other").astext()
+    assert "foo" in result.doctree("field").astext()
+    assert "{{ a }}" in result.doctree("notop").astext()
+    assert "{{ a }}" in result.doctree("plain").astext()
+
+    # test that changing the included template triggers a rebuild
+    (tmp_path / "base.jinja").write_text("bar{{ a }}")
+    result = run_sphinxbuild(tmp_path, clear_build=False)
+    assert not result.stderr
+    assert "barfoo 2.0" in result.doctree("glob/other").astext()
+
+
+SHARED_CONF_CONTENT = """
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+from counted import Counted
+
+def provider():
+    return {
+        "big": Counted("big", "SHARED_PAYLOAD"),
+        "unused": Counted("unused", "SHARED_PAYLOAD"),
+    }
+
+jinja2_contexts = {"ctx1": {"a": "foo"}}
+jinja2_context_providers = {"data": provider}
+jinja2_shared_contexts = ["data", "ctx1"]
+"""
+
+COUNTED_CONTENT = """
+import os
+from pathlib import Path
+
+def _load(name, payload):
+    with (Path(__file__).parent / "unpickles.txt").open("a") as handle:
+        handle.write(f"{os.getpid()} {name}\\n")
+    return Counted(name, payload)
+
+class Counted:
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = payload
+
+    def __reduce__(self):
+        return (_load, (self.name, self.payload))
+
+    def __str__(self):
+        return self.name
+"""
+
+
+def _write_shared_project(path: Path, num_docs: int) -> None:
+    (path / "conf.py").write_text(CONF_CONTENT + SHARED_CONF_CONTENT)
+    (path / "counted.py").write_text(COUNTED_CONTENT)
+    (path / "index.rst").write_text(
+        "Test\n====\n\n.. toctree::\n\n" + "".join(f"    doc{i}\n" for i in range(num_docs))
+    )
+    for i in range(num_docs):
+        (path / f"doc{i}.rst").write_text(
+            f"Doc {i}\n======\n\n"
+            + ".. jinja:: data\n\n    {{ big }}\n\n" * 2
+            + ".. jinja:: ctx1\n\n    {{ a }}\n\n"
+        )
+
+
+def _unpickles(path: Path) -> list[tuple[str, str]]:
+    lines = (path / "unpickles.txt").read_text().splitlines()
+    return [(pid, name) for pid, name in (line.split() for line in lines)]
+
+
+def test_shared_contexts(tmp_path: Path):
+    """Test that shared contexts are unpickled lazily, at most once per process,
+    and are not stored in the environment.
+    """
+    _write_shared_project(tmp_path, 3)
+    result = run_sphinxbuild(tmp_path)
+    assert "Shared context 'ctx1' is in jinja2_contexts" in result.stderr
+    assert (result.build / "doctrees" / "jinja2_contexts.mmap").is_file()
+    assert "big" in result.doctree("doc0").astext()
+    assert "foo" in result.doctree("doc0").astext()
+    # 6 directives use the context, but the value is only unpickled once
+    assert [name for _, name in _unpickles(tmp_path)] == ["big"]
+    assert b"SHARED_PAYLOAD" not in (result.build / "doctrees" / "environment.pickle").read_bytes()
+
+
+def test_shared_contexts_parallel(tmp_path: Path):
+    """Test that shared contexts are unpickled at most once per parallel worker."""
+    _write_shared_project(tmp_path, 8)
+    result = run_sphinxbuild(tmp_path, jobs=2)
+    assert "big" in result.doctree("doc7").astext()
+    unpickles = _unpickles(tmp_path)
+    assert {name for _, name in unpickles} == {"big"}
+    # each worker process unpickles the value once
+    assert len(unpickles) == len({pid for pid, _ in unpickles}) > 1
+    assert b"SHARED_PAYLOAD" not in (result.build / "doctrees" / "environment.pickle").read_bytes()
+
+
+def test_shared_contexts_include_in_loop(tmp_path: Path):
+    """Test that an include within a loop, which copies the whole context,
+    still renders and unpickles each value at most once.
+    """
+    _write_shared_project(tmp_path, 1)
+    (tmp_path / "inc.jinja").write_text("included {{ big }}")
+    (tmp_path / "doc0.rst").write_text(
+        "Doc 0\n=====\n\n"
+        ".. jinja:: data\n\n    {% for i in [1, 2] %}{% include 'inc.jinja' %}{% endfor %}\n\n"
+        ".. jinja:: data\n\n    {% with x = 1 %}{% include 'inc.jinja' %}{% endwith %}\n\n"
+    )
+    result = run_sphinxbuild(tmp_path)
+    assert result.doctree("doc0").astext().count("included big") == 3
+    # Jinja copies the parent context here, so all top-level variables are unpickled
+    assert sorted(name for _, name in _unpickles(tmp_path)) == ["big", "unused"]
+
+
+def test_render_sources_line_statements(tmp_path: Path):
+    """Test that documents using only line statements are rendered."""
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + "\njinja2_env_kwargs = {'line_statement_prefix': '%%'}"
+        + "\njinja2_render_sources = {'*': None}"
+    )
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+
+        %% for i in range(3)
+        item-
+        %% endfor
+        """
+        )
+    )
+    result = run_sphinxbuild(tmp_path)
+    assert not result.stderr
+    text = result.doctree().astext()
+    assert "%%" not in text
+    assert text.count("item-") == 3
+
+
+def test_usage_index(tmp_path: Path, capsys):
+    """Test that template and context usage is recorded, and can be queried."""
+    from sphinx_jinja2.cli import main
+
+    (tmp_path / "conf.py").write_text(CONF_CONTENT + "\njinja2_contexts = {'ctx1': {'a': 'foo'}}")
+    (tmp_path / "base.jinja").write_text("{% include 'inner.jinja' %}")
+    (tmp_path / "inner.jinja").write_text("{{ a }}")
+    (tmp_path / "unused.jinja").write_text("")
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. toctree::
+
+            other
+            plain
+
+        .. jinja:: ctx1
+
+            {% include "base.jinja" %}
+        """
+        )
+    )
+    (tmp_path / "other.rst").write_text(
+        dedent(
+            """\
+        Other
+        =====
+        .. jinja::
+            :file: inner.jinja
+            :ctx: {"a": "bar"}
+        """
+        )
+    )
+    (tmp_path / "plain.rst").write_text("Plain\n=====\n")
+    result = run_sphinxbuild(tmp_path)
+    assert not result.stderr
+    index_path = result.build / "doctrees" / "jinja2_usage.json"
+    documents = json.loads(index_path.read_text())["documents"]
+    assert documents["index"]["templates"] == ["base.jinja", "inner.jinja"]
+    assert documents["index"]["contexts"] == ["ctx1"]
+    assert documents["other"]["templates"] == ["inner.jinja"]
+    assert documents["other"]["contexts"] == []
+    # read times are recorded for all documents, to estimate full rebuilds
+    assert documents["plain"]["templates"] == []
+    assert documents["plain"]["read_time"] > 0
+
+    # test that changing a transitively included template triggers a rebuild
+    (tmp_path / "inner.jinja").write_text("{{ a }}2")
+    result = run_sphinxbuild(tmp_path, clear_build=False)
+    assert "foo2" in result.doctree().astext()
+
+    capsys.readouterr()
+    assert main(["impact", str(index_path), "inner.jinja"]) == 0
+    assert "2 document(s) affected" in capsys.readouterr().out
+    assert main(["impact", str(index_path), "ctx1"]) == 0
+    out = capsys.readouterr().out
+    assert "'ctx1' is in jinja2_contexts, so changing it re-reads all documents" in out
+    assert "3 document(s) affected" in out
+    assert main(["unused", str(index_path)]) == 0
+    assert capsys.readouterr().out == "unused.jinja\n"
+
+
+def test_async_render(tmp_path: Path):
+    """Test that coroutine filters and globals are awaited, that map_concurrent runs calls
+    concurrently, and that errors are reported.
+    """
+    (tmp_path / "conf.py").write_text(
+        CONF_CONTENT
+        + dedent(
+            """\
+        import asyncio
+        import threading
+
+        _lock = threading.Lock()
+        _in_flight = {"async": 0, "blocking": 0}
+        _max_in_flight = {"async": 0, "blocking": 0}
+        # blocking calls wait until all 4 are running (or fail if they are run sequentially)
+        _barrier = threading.Barrier(4, timeout=10)
+
+        def _enter(kind):
+            with _lock:
+                _in_flight[kind] += 1
+                _max_in_flight[kind] = max(_max_in_flight[kind], _in_flight[kind])
+
+        def _exit(kind):
+            with _lock:
+                _in_flight[kind] -= 1
+
+        async def lookup(value):
+            _enter("async")
+            try:
+                await asyncio.sleep(0.01)
+                return value * 2
+            finally:
+                _exit("async")
+
+        def blocking_lookup(value):
+            _enter("blocking")
+            try:
+                _barrier.wait()
+                return value * 3
+            finally:
+                _exit("blocking")
+
+        async def fetch():
+            return "fetched"
+
+        async def fail():
+            raise ValueError("bad")
+
+        def max_in_flight(kind):
+            return _max_in_flight[kind]
+
+        jinja2_async_render = True
+        jinja2_filters = {"lookup": lookup, "blocking_lookup": blocking_lookup}
+        jinja2_globals = {"fetch": fetch, "fail": fail, "max_in_flight": max_in_flight}
+        """
+        )
+    )
+    (tmp_path / "index.rst").write_text(
+        dedent(
+            """\
+        Test
+        ====
+        .. jinja::
+
+            {{ fetch() }} {{ 1|lookup }} {{ [1, 2, 3, 4]|map_concurrent("lookup")|join(",") }}
+            {{ [1, 2, 3, 4]|map_concurrent("blocking_lookup")|join(",") }}
+            max={{ max_in_flight("async") }},{{ max_in_flight("blocking") }}
+
+        .. jinja::
+
+            {{ fail() }}
+        """
+        )
+    )
+    result = run_sphinxbuild(tmp_path)
+    text = result.doctree().astext()
+    assert "fetched 2 2,4,6,8" in text
+    assert "3,6,9,12" in text
+    assert "max=4,4" in text
+    assert (
+        "index.rst:9: WARNING: Error rendering jinja template: ValueError: bad [jinja2]"
+        in result.stderr
+    )